@@ -5,10 +5,18 @@ Supports both interactive CLI mode and API server mode.
 """
 
 import argparse
+import asyncio
+import functools
+import importlib.util
 import json
 import sys
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Dict, Optional
+from typing import AsyncIterator, Dict, List, Optional, Union
 
 # Add project root to Python path
 project_root = Path(__file__).parent.parent
@@ -16,12 +24,64 @@ sys.path.insert(0, str(project_root))
 
 import torch
 import uvicorn
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from transformers import AutoTokenizer
+from transformers import (
+    AutoTokenizer,
+    DynamicCache,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TextIteratorStreamer,
+)
 import sentencepiece as spm
 
-from utils.model_utils import load_pretrained_model
+from utils.model_utils import load_pretrained_model, load_quantized_model
+
+
+# Micro-batching defaults for the API server
+MAX_BATCH_SIZE = 8
+MAX_WAIT_MS = 10.0
+
+# Prompt lengths are padded up to one of these so torch.compile sees few shapes
+PADDING_BUCKETS = (128, 256, 512, 1024, 2048)
+
+# Threads relaying streamed text to the event loop (generation itself runs on one thread)
+STREAM_PUMP_WORKERS = 8
+
+# Responses kept for repeated deterministic requests
+RESPONSE_CACHE_SIZE = 4096
+
+# Prompt templates ("{}" is replaced by the user prompt, raw = pas de formatage)
+_TEMPLATES = {
+    "chatml": "<|im_start|>user\n{}\n<|im_end|>\n<|im_start|>assistant\n",
+    "chat": "Human: {}\n\nAssistant: ",
+    "instruct": "### Instruction:\n{}\n\n### Response:\n",
+    "raw": "{}",
+}
+
+
+@functools.lru_cache(maxsize=1024)
+def format_prompt(prompt: str, template: str = "chatml") -> str:
+    """
+    Format prompt according to specified template (unknown templates are left raw).
+    
+    Args:
+        prompt: User prompt
+        template: Template to use
+        
+    Returns:
+        Formatted prompt
+    """
+    return _TEMPLATES.get(template, "{}").format(prompt)
+
+
+def _module_available(name: str) -> bool:
+    """Check whether an (optionally dotted) module can be imported."""
+    try:
+        return importlib.util.find_spec(name) is not None
+    except ModuleNotFoundError:
+        return False
 
 
 class SentencePieceTokenizerWrapper:
@@ -98,6 +158,18 @@ class SentencePieceTokenizerWrapper:
         return {'input_ids': input_ids}
 
 
+class StopOnEvent(StoppingCriteria):
+    """Stopping criteria ending generation once an event is set (client disconnected)."""
+    
+    def __init__(self, stop_event: threading.Event):
+        self.stop_event = stop_event
+    
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full(
+            (input_ids.shape[0],), self.stop_event.is_set(), dtype=torch.bool, device=input_ids.device
+        )
+
+
 class GenerationRequest(BaseModel):
     """Request model for generation API."""
     prompt: str
@@ -107,6 +179,7 @@ class GenerationRequest(BaseModel):
     top_k: Optional[int] = 50
     repetition_penalty: Optional[float] = 1.1
     do_sample: Optional[bool] = True
+    no_repeat_ngram_size: Optional[int] = 0
     template: Optional[str] = "chatml"
 
 
@@ -120,18 +193,110 @@ class GenerationResponse(BaseModel):
 class ModelServer:
     """Model server with text generation."""
     
-    def __init__(self, model_path: str, tokenizer_path: Optional[str] = None):
+    def __init__(
+        self,
+        model_path: str,
+        tokenizer_path: Optional[str] = None,
+        compile_model: bool = True,
+        quantize: str = "none",
+        kv_cache_dtype: str = "fp16",
+        prefix_cache: bool = False,
+        draft_model_path: Optional[str] = None,
+        response_cache_size: int = RESPONSE_CACHE_SIZE,
+        warmup_batch_sizes: tuple = (1,),
+        warmup_max_new_tokens: int = 96
+    ):
         """
         Initialize server with model and tokenizer.
         
         Args:
             model_path: Path to trained model
             tokenizer_path: Path to tokenizer (optional)
+            compile_model: Compile the forward pass with torch.compile
+            quantize: Weight quantization ("none", "int8" or "nf4")
+            kv_cache_dtype: KV cache precision ("fp16" keeps the model dtype, "int8" or "int4")
+            prefix_cache: Precompute KV states of the template prefixes
+            draft_model_path: Small model sharing the tokenizer, used for speculative decoding
+            response_cache_size: Cached responses for deterministic generations (0 = disabled)
+            warmup_batch_sizes: Batch sizes compiled at startup (when compile is enabled)
+            warmup_max_new_tokens: Serving max_new_tokens, which sizes the static KV cache at warmup
         """
+        if kv_cache_dtype not in ("fp16", "int8", "int4"):
+            raise ValueError(f"KV cache dtype {kv_cache_dtype} requires the vllm backend")
+        
+        # The prefix cache path decodes with a growing DynamicCache: no quantized or
+        # static cache, no bucket padding, hence no stable shapes for torch.compile
+        if prefix_cache and kv_cache_dtype != "fp16":
+            raise ValueError("--prefix_cache cannot be combined with a quantized KV cache")
+        if prefix_cache and compile_model:
+            print("⚠️  --prefix_cache decodes with a dynamic KV cache: torch.compile disabled")
+            compile_model = False
+        
+        # Assisted decoding changes the candidate count and KV length at every step:
+        # the reduce-overhead forward would recompile and recapture CUDA graphs
+        if draft_model_path and compile_model:
+            print("⚠️  --draft_model_path uses assisted decoding with a dynamic KV cache: torch.compile disabled")
+            compile_model = False
+        
+        # Quantized cache updates (dequantize/requantize of the residual window) are not
+        # capturable by the reduce-overhead forward
+        if kv_cache_dtype != "fp16" and compile_model:
+            print(f"⚠️  --kv_cache_dtype {kv_cache_dtype} decodes with a quantized dynamic KV cache: torch.compile disabled")
+            compile_model = False
+        
+        # Quantized KV cache backends are optional packages: fail before loading the model
+        if kv_cache_dtype != "fp16":
+            backend_module, package = ("hqq", "hqq") if kv_cache_dtype == "int8" else ("optimum.quanto", "optimum-quanto")
+            if not _module_available(backend_module):
+                raise ImportError(f"--kv_cache_dtype {kv_cache_dtype} requires the {package} package (pip install {package})")
+        
+        # TF32 tensor cores for the remaining FP32 matmuls (Ampere+)
+        torch.set_float32_matmul_precision('high')
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.backends.cudnn.benchmark = True
+        
+        # Fused SDPA kernels (FlashAttention / memory-efficient) for sdpa attention
+        torch.backends.cuda.enable_flash_sdp(True)
+        torch.backends.cuda.enable_mem_efficient_sdp(True)
+        
+        # The static KV cache (used with a compiled forward) is not supported by the
+        # FlashAttention-2 layers of several transformers releases: use SDPA with it
+        attn_implementation = "sdpa" if compile_model and hasattr(torch, "compile") else None
+        
         print(f"Loading model from {model_path}...")
-        self.model = load_pretrained_model(model_path)
+        if quantize != "none":
+            # bitsandbytes weights are already placed and typed by from_pretrained
+            self.model = load_quantized_model(model_path, quantize, attn_implementation=attn_implementation)
+            self.dtype = torch.float16
+        else:
+            # Half precision weights: decode is memory-bound on weight and KV bytes.
+            # Loading straight in the target dtype avoids a full FP32 copy in host RAM
+            self.dtype = torch.float16 if torch.cuda.is_available() else torch.bfloat16
+            self.model = load_pretrained_model(
+                model_path, torch_dtype=self.dtype, attn_implementation=attn_implementation
+            )
         self.model.eval()
         
+        # Draft model for speculative decoding: the main model verifies several
+        # drafted tokens per forward pass
+        self.draft_model = None
+        if draft_model_path:
+            print(f"Loading draft model from {draft_model_path}...")
+            self.draft_model = load_pretrained_model(draft_model_path, torch_dtype=self.dtype)
+            self.draft_model = self.draft_model.to(device=self.model.device, dtype=self.dtype)
+        
+        # KV cache setup: dynamic by default, static once the forward is compiled (see _compile)
+        self.cache_kwargs = {}
+        if kv_cache_dtype != "fp16":
+            # Quantized KV cache: fewer KV bytes streamed per decoding step
+            nbits = 8 if kv_cache_dtype == "int8" else 4
+            self.cache_kwargs = {
+                "cache_implementation": "quantized",
+                "cache_config": {"backend": "HQQ" if nbits == 8 else "quanto", "nbits": nbits}
+            }
+        self.model.generation_config.cache_implementation = self.cache_kwargs.get("cache_implementation")
+        
         # Load tokenizer
         if tokenizer_path:
             # Handle SentencePiece tokenizer files
@@ -146,11 +311,137 @@ class ModelServer:
         if self.tokenizer.pad_token is None:
             self.tokenizer.pad_token = self.tokenizer.eos_token
         
+        # Left-padding id: the tokenizer pad token is EOS, which repetition_penalty
+        # would then always penalize (the attention mask hides padding anyway)
+        self.pad_token_id = self.model.config.pad_token_id
+        if self.pad_token_id is None or self.pad_token_id == self.tokenizer.eos_token_id:
+            self.pad_token_id = 0
+        
+        # Pre-tokenized template wrappers: only the user prompt is tokenized per request.
+        # Trailing whitespace of the prefix stays with the prompt, where BPE tokenizers
+        # merge it into the first word ("Human: " + "Hi" -> "Human:", " Hi")
+        self.template_ids = {}
+        for template, template_format in _TEMPLATES.items():
+            prefix, _, suffix = template_format.partition("{}")
+            head = prefix.rstrip()
+            wrapped = (
+                self.tokenizer.encode(head, add_special_tokens=True),
+                prefix[len(head):],
+                self.tokenizer.encode(suffix, add_special_tokens=False) if suffix else []
+            )
+            
+            # Tokenizers that still split differently (e.g. SentencePiece dummy prefix)
+            # encode the full formatted prompt instead
+            probe = "Hello, how are you?"
+            split_ids = wrapped[0] + self.tokenizer.encode(wrapped[1] + probe, add_special_tokens=False) + wrapped[2]
+            if split_ids != self.tokenizer.encode(template_format.format(probe), add_special_tokens=True):
+                wrapped = None
+            self.template_ids[template] = wrapped
+        
         # Inference optimizations
         self.device = next(self.model.parameters()).device
+        self.num_parameters = sum(p.numel() for p in self.model.parameters())
         
-        print(f"Model loaded on {self.device}")
-        print(f"Parameters: {sum(p.numel() for p in self.model.parameters()):,}")
+        # KV states of the constant template prefixes, reused by single requests.
+        # Built with the eager forward: outputs of a reduce-overhead compiled forward
+        # live in the CUDA graph memory pool and may be overwritten
+        self.prefix_cache = {}
+        if prefix_cache:
+            self._build_prefix_cache()
+        
+        # Single worker owning the model: CUDA graphs captured by the reduce-overhead
+        # forward are thread-local, so warmup and serving must run on the same thread
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lumi-generate")
+        # Streamer reads block until the next chunk: keep them off the default executor
+        self._stream_executor = ThreadPoolExecutor(
+            max_workers=STREAM_PUMP_WORKERS, thread_name_prefix="lumi-stream"
+        )
+        
+        self.compiled = False
+        self.warmup_batch_sizes = warmup_batch_sizes
+        self.warmup_max_new_tokens = warmup_max_new_tokens
+        if compile_model and hasattr(torch, "compile"):
+            self._compile()
+        
+        # LRU cache of responses keyed on prompt, template and generation parameters
+        self.response_cache: OrderedDict = OrderedDict()
+        self.response_cache_size = response_cache_size
+        
+        print(f"Model loaded on {self.device} ({self.dtype}, attention: {self.model.config._attn_implementation})")
+        print(f"Parameters: {self.num_parameters:,}")
+    
+    def _compile(self):
+        """Compile the model forward and warm it up, falling back to eager mode on failure."""
+        # Compile the forward pass only: generate() stays the regular HF method
+        # and calls the compiled forward at every decoding step
+        eager_forward = self.model.forward
+        eager_cache_kwargs = self.cache_kwargs
+        print("Compiling model forward with torch.compile...")
+        
+        try:
+            # HF generate calls the model with varying sequence lengths
+            torch._dynamo.config.cache_size_limit = 64
+            self.model.forward = torch.compile(
+                eager_forward, mode="reduce-overhead", fullgraph=False
+            )
+            self.compiled = True
+            
+            # Pre-allocated KV cache: fixed shapes across decoding steps let the
+            # compiled forward be captured once instead of recompiling per step
+            self.cache_kwargs = {"cache_implementation": "static"}
+            self.model.generation_config.cache_implementation = "static"
+            
+            # Compilation is lazy: errors (missing toolchain, unsupported op) surface here
+            self.executor.submit(self._warmup).result()
+        except Exception as e:
+            print(f"⚠️  torch.compile failed, falling back to eager mode: {e}")
+            torch._dynamo.reset()
+            self.model.forward = eager_forward
+            self.compiled = False
+            
+            # In eager mode a static cache only adds work (full-length buffers and attention)
+            self.cache_kwargs = eager_cache_kwargs
+            self.model.generation_config.cache_implementation = self.cache_kwargs.get("cache_implementation")
+    
+    def _warmup(self):
+        """Run short dummy generations so the first requests do not pay the trace cost."""
+        print("Warming up compiled model...")
+        for batch_size in sorted(set(self.warmup_batch_sizes)):
+            # Smallest padding bucket: the prompt shape most requests end up with
+            dummy_ids = torch.full(
+                (batch_size, PADDING_BUCKETS[0]), self.pad_token_id, dtype=torch.long, device=self.device
+            )
+            with torch.inference_mode(), torch.autocast(device_type=self.device.type, dtype=self.dtype):
+                # Covers both the prefill and the single-token decode shapes. The
+                # serving max_new_tokens gives the static cache its real size; EOS
+                # is disabled so the whole decode loop runs
+                self.model.generate(
+                    dummy_ids,
+                    attention_mask=torch.ones_like(dummy_ids),
+                    max_new_tokens=self.warmup_max_new_tokens,
+                    min_new_tokens=self.warmup_max_new_tokens,
+                    do_sample=False,
+                    pad_token_id=self.pad_token_id,
+                    **self.cache_kwargs
+                )
+    
+    def _build_prefix_cache(self):
+        """Run each template prefix through the model once and keep its KV states."""
+        print("Precomputing template prefix KV cache...")
+        for template, wrapped in self.template_ids.items():
+            # Templates without a suffix (raw) may leave no token to prefill
+            if wrapped is None or not wrapped[0] or not wrapped[2]:
+                continue
+            prefix_ids = wrapped[0]
+            
+            input_ids = torch.tensor([prefix_ids], dtype=torch.long, device=self.device)
+            with torch.inference_mode(), torch.autocast(device_type=self.device.type, dtype=self.dtype):
+                outputs = self.model(input_ids=input_ids, use_cache=True)
+            
+            past_key_values = outputs.past_key_values
+            if hasattr(past_key_values, "to_legacy_cache"):
+                past_key_values = past_key_values.to_legacy_cache()
+            self.prefix_cache[template] = past_key_values
     
     def format_prompt(self, prompt: str, template: str = "chatml") -> str:
         """
@@ -163,15 +454,7 @@ class ModelServer:
         Returns:
             Formatted prompt
         """
-        if template == "chatml":
-            return f"<|im_start|>user\n{prompt}\n<|im_end|>\n<|im_start|>assistant\n"
-        elif template == "chat":
-            return f"Human: {prompt}\n\nAssistant: "
-        elif template == "instruct":
-            return f"### Instruction:\n{prompt}\n\n### Response:\n"
-        else:
-            # Template raw - pas de formatage
-            return prompt
+        return format_prompt(prompt, template)
     
     def generate(
         self,
@@ -182,6 +465,7 @@ class ModelServer:
         top_k: int = 50,
         repetition_penalty: float = 1.1,
         do_sample: bool = True,
+        no_repeat_ngram_size: int = 0,
         template: str = "chatml"
     ) -> tuple[str, str]:
         """
@@ -194,80 +478,603 @@ class ModelServer:
             top_p: Top-p sampling
             repetition_penalty: Repetition penalty
             do_sample: Use sampling
+            no_repeat_ngram_size: Block repeated n-grams of this size (0 = disabled)
             template: Template de formatage
             
         Returns:
             Tuple (formatted_prompt, generated_response)
         """
-        # Formatage du prompt
-        formatted_prompt = self.format_prompt(prompt, template)
-        
-        # Tokenisation
-        inputs = self.tokenizer(
-            formatted_prompt,
-            return_tensors="pt",
-            truncation=True,
-            max_length=2048
+        return self.generate_batch(
+            [prompt],
+            [template],
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            top_k=top_k,
+            repetition_penalty=repetition_penalty,
+            do_sample=do_sample,
+            no_repeat_ngram_size=no_repeat_ngram_size
+        )[0]
+    
+    def generate_batch(
+        self,
+        prompts: List[str],
+        templates: List[str],
+        max_new_tokens: int = 96,
+        temperature: float = 0.8,
+        top_p: float = 0.9,
+        top_k: int = 50,
+        repetition_penalty: float = 1.1,
+        do_sample: bool = True,
+        no_repeat_ngram_size: int = 0
+    ) -> List[tuple[str, str]]:
+        """
+        Generate responses for several prompts sharing the same generation parameters.
+        
+        Args:
+            prompts: Prompts utilisateur
+            templates: Template de formatage for each prompt
+            max_new_tokens: Nombre maximum de nouveaux tokens
+            temperature: Generation temperature
+            top_p: Top-p sampling
+            repetition_penalty: Repetition penalty
+            do_sample: Use sampling
+            no_repeat_ngram_size: Block repeated n-grams of this size (0 = disabled)
+            
+        Returns:
+            List of tuples (formatted_prompt, generated_response), in input order
+        """
+        generation_params = {
+            "max_new_tokens": max_new_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "top_k": top_k,
+            "repetition_penalty": repetition_penalty,
+            "do_sample": do_sample,
+            "no_repeat_ngram_size": no_repeat_ngram_size
+        }
+        
+        # Only (near-)deterministic generations can be served from the cache
+        use_cache = self.response_cache_size > 0 and (not do_sample or temperature <= 0.01)
+        if not use_cache:
+            return self._generate_batch_uncached(prompts, templates, **generation_params)
+        
+        params_key = tuple(generation_params.values())
+        keys = [(prompt, template) + params_key for prompt, template in zip(prompts, templates)]
+        
+        results = [None] * len(prompts)
+        for i, key in enumerate(keys):
+            if key in self.response_cache:
+                self.response_cache.move_to_end(key)
+                results[i] = self.response_cache[key]
+        
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            generated = self._generate_batch_uncached(
+                [prompts[i] for i in missing],
+                [templates[i] for i in missing],
+                **generation_params
+            )
+            for i, result in zip(missing, generated):
+                results[i] = result
+                self.response_cache[keys[i]] = result
+                if len(self.response_cache) > self.response_cache_size:
+                    self.response_cache.popitem(last=False)
+        
+        return results
+    
+    def _generate_batch_uncached(
+        self,
+        prompts: List[str],
+        templates: List[str],
+        **generation_params
+    ) -> List[tuple[str, str]]:
+        """Run the model for a batch of prompts (same arguments as generate_batch)."""
+        # Formatage des prompts
+        formatted_prompts = [
+            self.format_prompt(prompt, template)
+            for prompt, template in zip(prompts, templates)
+        ]
+        
+        _, padded_len, generation_config = self._prepare_generation(
+            prompts, templates, **generation_params
+        )
+        
+        # Generation
+        outputs = self._run_generate(generation_config)
+        
+        results = []
+        for i, formatted_prompt in enumerate(formatted_prompts):
+            # Decoding of the new tokens only: every prompt ends at padded_len
+            generated_response = self.tokenizer.decode(
+                outputs[i, padded_len:], skip_special_tokens=True
+            ).strip()
+            results.append((formatted_prompt, generated_response))
+        
+        return results
+    
+    def generate_stream(
+        self,
+        prompt: str,
+        max_new_tokens: int = 96,
+        temperature: float = 0.8,
+        top_p: float = 0.9,
+        top_k: int = 50,
+        repetition_penalty: float = 1.1,
+        do_sample: bool = True,
+        no_repeat_ngram_size: int = 0,
+        template: str = "chatml"
+    ) -> tuple[TextIteratorStreamer, threading.Event]:
+        """
+        Queue generation on the model executor and stream the decoded text.
+        
+        Args:
+            prompt: Prompt utilisateur
+            max_new_tokens: Nombre maximum de nouveaux tokens
+            temperature: Generation temperature
+            top_p: Top-p sampling
+            repetition_penalty: Repetition penalty
+            do_sample: Use sampling
+            no_repeat_ngram_size: Block repeated n-grams of this size (0 = disabled)
+            template: Template de formatage
+            
+        Returns:
+            Tuple (streamer yielding text chunks, event stopping the generation when set).
+            If generation fails, the streamer ends early and its error attribute holds the exception
+        """
+        _, _, generation_config = self._prepare_generation(
+            [prompt],
+            [template],
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            top_k=top_k,
+            repetition_penalty=repetition_penalty,
+            do_sample=do_sample,
+            no_repeat_ngram_size=no_repeat_ngram_size
+        )
+        
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        stop_event = threading.Event()
+        generation_config["streamer"] = streamer
+        generation_config["stopping_criteria"] = StoppingCriteriaList([StopOnEvent(stop_event)])
+        
+        # Set by the generation thread on failure, re-raised by the consumer
+        streamer.error = None
+        
+        def run():
+            # Client gone while the request was queued behind other generations
+            if stop_event.is_set():
+                streamer.end()
+                return
+            try:
+                self._run_generate(generation_config)
+            except Exception as e:
+                print(f"❌ Generation error: {e}")
+                streamer.error = e
+                # Unblock the consumer, which would otherwise wait forever
+                streamer.end()
+        
+        self.executor.submit(run)
+        
+        return streamer, stop_event
+    
+    async def stream_async(self, prompt: str, **kwargs) -> AsyncIterator[str]:
+        """Async iterator over generated text chunks (same arguments as generate_stream)."""
+        streamer, stop_event = self.generate_stream(prompt, **kwargs)
+        loop = asyncio.get_running_loop()
+        
+        try:
+            while True:
+                text = await loop.run_in_executor(self._stream_executor, next, streamer, None)
+                if text is None:
+                    break
+                if text:
+                    yield text
+            
+            if streamer.error is not None:
+                raise streamer.error
+        finally:
+            # Client gone or generation finished: stop decoding early
+            stop_event.set()
+    
+    def _prepare_generation(
+        self,
+        prompts: List[str],
+        templates: List[str],
+        max_new_tokens: int,
+        temperature: float,
+        top_p: float,
+        top_k: int,
+        repetition_penalty: float,
+        do_sample: bool,
+        no_repeat_ngram_size: int
+    ) -> tuple[List[List[int]], int, Dict]:
+        """
+        Tokenize and pad prompts, and build the model.generate keyword arguments.
+        
+        Returns:
+            Tuple (token ids per prompt, padded length, generate kwargs including inputs)
+        """
+        # Tokenisation: user prompt only, wrapped with the pre-tokenized template
+        encoded = []
+        for prompt, template in zip(prompts, templates):
+            template = template if template in self.template_ids else "raw"
+            wrapped = self.template_ids[template]
+            if wrapped is None:
+                ids = self.tokenizer.encode(format_prompt(prompt, template), add_special_tokens=True)
+            else:
+                prefix_ids, lead, suffix_ids = wrapped
+                ids = prefix_ids + self.tokenizer.encode(lead + prompt, add_special_tokens=False) + suffix_ids
+            encoded.append(ids[:2048])
+        
+        # A single request can start from the cached template prefix (no padding)
+        use_prefix_cache = len(encoded) == 1 and templates[0] in self.prefix_cache
+        
+        # Left padding so that every sequence ends where generation starts
+        padded_len = max(len(ids) for ids in encoded)
+        if self.compiled and not use_prefix_cache:
+            # Fixed bucket lengths keep the compiled graphs reusable across requests
+            padded_len = next(b for b in PADDING_BUCKETS if b >= padded_len)
+        # Pinned host buffers allow asynchronous host-to-device copies
+        pin_memory = self.device.type == "cuda"
+        input_ids = torch.full(
+            (len(encoded), padded_len), self.pad_token_id, dtype=torch.long, pin_memory=pin_memory
         )
-        # Move to device
-        inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        attention_mask = torch.zeros((len(encoded), padded_len), dtype=torch.long, pin_memory=pin_memory)
+        for i, ids in enumerate(encoded):
+            input_ids[i, padded_len - len(ids):] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[i, padded_len - len(ids):] = 1
         
         # Generation configuration with default parameters
         generation_config = {
+            # Move to device (non-blocking: overlaps with the rest of the setup)
+            "input_ids": input_ids.to(self.device, non_blocking=True),
+            "attention_mask": attention_mask.to(self.device, non_blocking=True),
             "max_new_tokens": max_new_tokens,
             "temperature": temperature,
             "top_p": top_p,
             "top_k": top_k,
             "repetition_penalty": repetition_penalty,
             "do_sample": do_sample,
-            "pad_token_id": self.tokenizer.pad_token_id,
-            "eos_token_id": self.tokenizer.eos_token_id,
-            "no_repeat_ngram_size": 3
+            "pad_token_id": self.pad_token_id,
+            "eos_token_id": self.tokenizer.eos_token_id
         }
         
-        # Only add early_stopping for beam search (not sampling)
-        if not do_sample:
-            generation_config["early_stopping"] = True
+        # The n-gram check runs in Python over the whole sequence at every step: opt-in only
+        if no_repeat_ngram_size:
+            generation_config["no_repeat_ngram_size"] = no_repeat_ngram_size
         
-        # Generation
-        with torch.no_grad():
-            outputs = self.model.generate(
-                inputs['input_ids'],
-                attention_mask=inputs['attention_mask'],
-                **generation_config
+        if use_prefix_cache:
+            # Fresh containers around the shared prefix tensors: the cache grows
+            # by concatenation, so the stored prefix states are never modified
+            generation_config["past_key_values"] = DynamicCache.from_legacy_cache(
+                self.prefix_cache[templates[0]]
             )
+            # Overrides the model default, which cannot be combined with past_key_values
+            generation_config["cache_implementation"] = None
+        else:
+            # KV cache sized to prompt + max_new_tokens by generate
+            generation_config.update(self.cache_kwargs)
+        
+        # Assisted generation only supports a batch of one
+        if self.draft_model is not None and len(encoded) == 1:
+            generation_config["assistant_model"] = self.draft_model
+            generation_config["num_assistant_tokens"] = 5
+            if not use_prefix_cache:
+                # Assisted decoding rolls back rejected tokens in a dynamic cache
+                generation_config.pop("cache_config", None)
+                generation_config["cache_implementation"] = None
+        
+        return encoded, padded_len, generation_config
+    
+    def _run_generate(self, generation_config: Dict) -> torch.Tensor:
+        """Run model.generate (called on the model executor, which serializes all calls)."""
+        with torch.inference_mode(), torch.autocast(device_type=self.device.type, dtype=self.dtype):
+            return self.model.generate(**generation_config)
+
+
+class VLLMModelServer:
+    """Model server backed by vLLM (PagedAttention, continuous batching, prefix caching)."""
+    
+    def __init__(
+        self,
+        model_path: str,
+        tokenizer_path: Optional[str] = None,
+        kv_cache_dtype: str = "fp16"
+    ):
+        """
+        Initialize the vLLM engine.
+        
+        Args:
+            model_path: Path to trained model
+            tokenizer_path: Path to a HuggingFace tokenizer (optional)
+            kv_cache_dtype: KV cache precision ("fp16" keeps the model dtype, or "fp8")
+        """
+        try:
+            from vllm import AsyncEngineArgs, AsyncLLMEngine, SamplingParams
+        except ImportError:
+            raise ImportError("vllm backend requires the vllm package (pip install vllm)")
+        
+        if kv_cache_dtype not in ("fp16", "fp8"):
+            raise ValueError(f"KV cache dtype {kv_cache_dtype} is not supported by the vllm backend")
+        
+        self.sampling_params_cls = SamplingParams
+        
+        # vLLM only loads HuggingFace tokenizers: SentencePiece .model files fall
+        # back to the tokenizer saved with the model
+        if tokenizer_path and tokenizer_path.endswith('.model'):
+            print(f"⚠️  vllm backend cannot load {tokenizer_path}, using tokenizer from {model_path}")
+            tokenizer_path = None
+        
+        print(f"Loading model from {model_path} with vLLM...")
+        engine_args = AsyncEngineArgs(
+            model=model_path,
+            tokenizer=tokenizer_path,
+            dtype="float16",
+            kv_cache_dtype="fp8" if kv_cache_dtype == "fp8" else "auto",
+            enable_prefix_caching=True
+        )
+        self.engine = AsyncLLMEngine.from_engine_args(engine_args)
+        
+        self.device = torch.device("cuda")
+        self.num_parameters = None
+        
+        # Event loop for synchronous calls (interactive mode)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        
+        print(f"Model loaded on {self.device} (vllm)")
+    
+    def _sampling_params(
+        self,
+        max_new_tokens: int,
+        temperature: float,
+        top_p: float,
+        top_k: int,
+        repetition_penalty: float,
+        do_sample: bool
+    ):
+        """Translate generation parameters to vLLM SamplingParams."""
+        if not do_sample:
+            # Greedy decoding
+            temperature, top_p, top_k = 0.0, 1.0, -1
+        
+        return self.sampling_params_cls(
+            max_tokens=max_new_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            top_k=top_k,
+            repetition_penalty=repetition_penalty
+        )
+    
+    async def generate_async(
+        self,
+        prompt: str,
+        max_new_tokens: int = 96,
+        temperature: float = 0.8,
+        top_p: float = 0.9,
+        top_k: int = 50,
+        repetition_penalty: float = 1.1,
+        do_sample: bool = True,
+        no_repeat_ngram_size: int = 0,
+        template: str = "chatml"
+    ) -> tuple[str, str]:
+        """
+        Generate response from prompt with the vLLM engine.
+        
+        Args:
+            prompt: Prompt utilisateur
+            max_new_tokens: Nombre maximum de nouveaux tokens
+            temperature: Generation temperature
+            top_p: Top-p sampling
+            repetition_penalty: Repetition penalty
+            do_sample: Use sampling
+            no_repeat_ngram_size: Not supported by vLLM, ignored
+            template: Template de formatage
+            
+        Returns:
+            Tuple (formatted_prompt, generated_response)
+        """
+        formatted_prompt = format_prompt(prompt, template)
+        sampling_params = self._sampling_params(
+            max_new_tokens, temperature, top_p, top_k, repetition_penalty, do_sample
+        )
+        
+        final_output = None
+        async for output in self.engine.generate(formatted_prompt, sampling_params, uuid.uuid4().hex):
+            final_output = output
         
-        # Decoding
-        full_response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
+        return formatted_prompt, final_output.outputs[0].text.strip()
+    
+    async def stream_async(
+        self,
+        prompt: str,
+        max_new_tokens: int = 96,
+        temperature: float = 0.8,
+        top_p: float = 0.9,
+        top_k: int = 50,
+        repetition_penalty: float = 1.1,
+        do_sample: bool = True,
+        no_repeat_ngram_size: int = 0,
+        template: str = "chatml"
+    ) -> AsyncIterator[str]:
+        """Async iterator over generated text chunks (same arguments as generate_async)."""
+        formatted_prompt = format_prompt(prompt, template)
+        sampling_params = self._sampling_params(
+            max_new_tokens, temperature, top_p, top_k, repetition_penalty, do_sample
+        )
+        request_id = uuid.uuid4().hex
+        
+        sent_len = 0
+        finished = False
+        try:
+            # vLLM yields the cumulative text: only send the new part
+            async for output in self.engine.generate(formatted_prompt, sampling_params, request_id):
+                text = output.outputs[0].text
+                if len(text) > sent_len:
+                    yield text[sent_len:]
+                    sent_len = len(text)
+                finished = output.finished
+        finally:
+            # Client gone: free the sequence in the engine
+            if not finished:
+                await self.engine.abort(request_id)
+    
+    def generate(self, prompt: str, **kwargs) -> tuple[str, str]:
+        """Synchronous wrapper around generate_async (same arguments)."""
+        # The engine's background loop is bound to the first event loop using it
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        return self._loop.run_until_complete(self.generate_async(prompt, **kwargs))
+
+
+class BatchScheduler:
+    """Micro-batching scheduler grouping concurrent API requests into one generate call."""
+    
+    def __init__(
+        self,
+        model_server: ModelServer,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        max_wait_ms: float = MAX_WAIT_MS
+    ):
+        """
+        Args:
+            model_server: Model server running the batched generation
+            max_batch_size: Maximum number of requests per batch
+            max_wait_ms: Maximum time to wait for more requests after the first one
+        """
+        self.model_server = model_server
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        """Start the background batching task (must run inside the event loop)."""
+        self.queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Cancel the background batching task."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+    
+    async def submit(self, prompt: str, template: str, **generation_kwargs) -> tuple[str, str]:
+        """
+        Queue a request and wait for its result.
+        
+        Args:
+            prompt: Prompt utilisateur
+            template: Template de formatage
+            **generation_kwargs: Generation parameters forwarded to generate_batch
+            
+        Returns:
+            Tuple (formatted_prompt, generated_response)
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((prompt, template, generation_kwargs, future))
+        return await future
+    
+    async def _run(self):
+        """Collect requests up to max_batch_size or max_wait_ms, then run them."""
+        loop = asyncio.get_running_loop()
         
-        # Extract generated response (remove prompt)
-        generated_response = full_response[len(formatted_prompt):].strip()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait_ms / 1000
+            
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            # Only requests sharing the same generation parameters can run together
+            groups: Dict[tuple, list] = {}
+            for item in batch:
+                groups.setdefault(tuple(sorted(item[2].items())), []).append(item)
+            
+            for items in groups.values():
+                await self._run_group(items)
+    
+    async def _run_group(self, items: list):
+        """Run one batched generation off the event loop and dispatch the results."""
+        prompts = [item[0] for item in items]
+        templates = [item[1] for item in items]
+        generation_kwargs = items[0][2]
         
-        return formatted_prompt, generated_response
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                self.model_server.executor,
+                functools.partial(
+                    self.model_server.generate_batch, prompts, templates, **generation_kwargs
+                )
+            )
+        except Exception as e:
+            for item in items:
+                if not item[3].done():
+                    item[3].set_exception(e)
+            return
+        
+        for item, result in zip(items, results):
+            if not item[3].done():
+                item[3].set_result(result)
 
 
-def create_app(model_server: ModelServer) -> FastAPI:
+def create_app(
+    model_server: Union[ModelServer, VLLMModelServer],
+    max_batch_size: int = MAX_BATCH_SIZE,
+    max_wait_ms: float = MAX_WAIT_MS
+) -> FastAPI:
     """Create FastAPI application."""
     
+    # vLLM batches requests itself (continuous batching)
+    if isinstance(model_server, VLLMModelServer):
+        scheduler = None
+        submit = model_server.generate_async
+    else:
+        scheduler = BatchScheduler(model_server, max_batch_size, max_wait_ms)
+        submit = scheduler.submit
+    
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        if scheduler is not None:
+            scheduler.start()
+        yield
+        if scheduler is not None:
+            await scheduler.stop()
+    
     app = FastAPI(
         title="Lumi Model Server",
         description="API to interact with trained Lumi model",
-        version="1.0.0"
+        version="1.0.0",
+        lifespan=lifespan
     )
     
     @app.get("/")
     async def root():
         """Root endpoint with model information."""
-        return {
+        info = {
             "message": "Lumi Model Server",
             "model_device": str(model_server.device),
-            "model_parameters": sum(p.numel() for p in model_server.model.parameters()),
-            "available_templates": ["chatml", "chat", "instruct", "raw"],
+            "available_templates": list(_TEMPLATES),
             "endpoints": {
                 "generate": "/generate - Text generation",
+                "generate_stream": "/generate/stream - Text generation streamed as Server-Sent Events",
                 "health": "/health - Status du serveur"
             }
         }
+        # Not exposed by the vLLM engine
+        if model_server.num_parameters is not None:
+            info["model_parameters"] = model_server.num_parameters
+        return info
     
     @app.get("/health")
     async def health():
@@ -286,15 +1093,16 @@ def create_app(model_server: ModelServer) -> FastAPI:
             Generated response
         """
         try:
-            formatted_prompt, response = model_server.generate(
+            formatted_prompt, response = await submit(
                 prompt=request.prompt,
+                template=request.template,
                 max_new_tokens=request.max_new_tokens,
                 temperature=request.temperature,
                 top_p=request.top_p,
                 top_k=getattr(request, 'top_k', 50),
                 repetition_penalty=request.repetition_penalty,
                 do_sample=request.do_sample,
-                template=request.template
+                no_repeat_ngram_size=request.no_repeat_ngram_size
             )
             
             return GenerationResponse(
@@ -306,6 +1114,7 @@ def create_app(model_server: ModelServer) -> FastAPI:
                     "top_p": request.top_p,
                     "top_k": getattr(request, 'top_k', 50),
                     "repetition_penalty": request.repetition_penalty,
+                    "no_repeat_ngram_size": request.no_repeat_ngram_size,
                     "template": request.template
                 }
             )
@@ -313,6 +1122,47 @@ def create_app(model_server: ModelServer) -> FastAPI:
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Generation error: {str(e)}")
     
+    @app.post("/generate/stream")
+    async def generate_stream(request: GenerationRequest, http_request: Request):
+        """
+        Streaming text generation endpoint (Server-Sent Events).
+        
+        Args:
+            request: Generation request
+            http_request: Underlying HTTP request (disconnect detection)
+            
+        Returns:
+            Event stream of {"token": ...} messages, terminated by [DONE] or by an {"error": ...} message
+        """
+        chunks = model_server.stream_async(
+            prompt=request.prompt,
+            max_new_tokens=request.max_new_tokens,
+            temperature=request.temperature,
+            top_p=request.top_p,
+            top_k=getattr(request, 'top_k', 50),
+            repetition_penalty=request.repetition_penalty,
+            do_sample=request.do_sample,
+            no_repeat_ngram_size=request.no_repeat_ngram_size,
+            template=request.template
+        )
+        
+        async def event_stream():
+            try:
+                async for text in chunks:
+                    if await http_request.is_disconnected():
+                        return
+                    yield f"data: {json.dumps({'token': text})}\n\n"
+            except Exception as e:
+                # Error event instead of [DONE]: the client can tell a failure from a short answer
+                yield f"data: {json.dumps({'error': f'Generation error: {str(e)}'})}\n\n"
+            else:
+                yield "data: [DONE]\n\n"
+            finally:
+                # Stops decoding early if the client disconnected
+                await chunks.aclose()
+        
+        return StreamingResponse(event_stream(), media_type="text/event-stream")
+    
     return app
 
 
@@ -348,7 +1198,8 @@ def interactive_mode(model_server: ModelServer, args):
             print("🤖 Lumi: ", end="", flush=True)
             
             try:
-                _, response = model_server.generate(
+                _, response = model_server.executor.submit(
+                    model_server.generate,
                     prompt=user_input,
                     max_new_tokens=args.max_new_tokens,
                     temperature=args.temperature,
@@ -356,8 +1207,9 @@ def interactive_mode(model_server: ModelServer, args):
                     top_k=getattr(args, 'top_k', 50),
                     repetition_penalty=args.repetition_penalty,
                     do_sample=args.do_sample,
+                    no_repeat_ngram_size=args.no_repeat_ngram_size,
                     template=args.template
-                )
+                ).result()
                 
                 print(response)
                 
@@ -391,17 +1243,47 @@ def main():
                        help="Top-k sampling")
     parser.add_argument("--repetition_penalty", type=float, default=1.1,
                        help="Repetition penalty")
+    parser.add_argument("--no_repeat_ngram_size", type=int, default=0,
+                       help="Block repeated n-grams of this size (0 = disabled, slows decoding)")
     parser.add_argument("--do_sample", action="store_true", default=True,
                        help="Use sampling")
     parser.add_argument("--template", type=str, default="chatml",
-                       choices=["chatml", "chat", "instruct", "raw"],
+                       choices=list(_TEMPLATES),
                        help="Template de formatage des prompts")
     
+    # Inference optimizations
+    parser.add_argument("--backend", type=str, default="hf",
+                       choices=["hf", "vllm"],
+                       help="Inference backend: HuggingFace generate or vLLM engine")
+    parser.add_argument("--no_compile", action="store_true",
+                       help="Disable torch.compile of the model forward")
+    parser.add_argument("--quantize", type=str, default="none",
+                       choices=["none", "int8", "nf4"],
+                       help="bitsandbytes weight quantization (CUDA only)")
+    parser.add_argument("--kv_cache_dtype", type=str, default="fp16",
+                       choices=["fp16", "fp8", "int8", "int4"],
+                       help="KV cache precision (fp16 = model dtype; fp8 with vllm only, int8/int4 with hf only)")
+    parser.add_argument("--prefix_cache", action="store_true",
+                       help="Reuse precomputed KV states of the template prefix for single requests "
+                            "(dynamic KV cache: disables torch.compile, requires --kv_cache_dtype fp16)")
+    parser.add_argument("--draft_model_path", type=str, default=None,
+                       help="Small draft model (same tokenizer) for speculative decoding, hf backend only "
+                            "(disables torch.compile)")
+    parser.add_argument("--response_cache_size", type=int, default=RESPONSE_CACHE_SIZE,
+                       help="Cached responses for deterministic requests (do_sample off or temperature <= 0.01, 0 = disabled)")
+    
     # API parameters
     parser.add_argument("--host", type=str, default="127.0.0.1",
                        help="Adresse IP pour le serveur API")
     parser.add_argument("--port", type=int, default=8000,
                        help="Port pour le serveur API")
+    parser.add_argument("--max_batch_size", type=int, default=MAX_BATCH_SIZE,
+                       help="Maximum number of concurrent requests batched together")
+    parser.add_argument("--max_wait_ms", type=float, default=MAX_WAIT_MS,
+                       help="Maximum wait (ms) to fill a batch after the first request")
+    parser.add_argument("--log_level", type=str, default="warning",
+                       choices=["debug", "info", "warning", "error"],
+                       help="Uvicorn log level (info logs every request)")
     
     args = parser.parse_args()
     
@@ -412,7 +1294,32 @@ def main():
     
     # Initialize model server
     try:
-        model_server = ModelServer(args.model_path, args.tokenizer_path)
+        if args.backend == "vllm":
+            # Options of the HF generate path: vLLM schedules, caches and compiles on its own
+            hf_options = ["quantize", "prefix_cache", "draft_model_path", "no_compile",
+                          "response_cache_size", "max_batch_size", "max_wait_ms"]
+            for option in hf_options:
+                if getattr(args, option) != parser.get_default(option):
+                    print(f"⚠️  --{option} is ignored by the vllm backend")
+            model_server = VLLMModelServer(
+                args.model_path,
+                args.tokenizer_path,
+                kv_cache_dtype=args.kv_cache_dtype
+            )
+        else:
+            model_server = ModelServer(
+                args.model_path,
+                args.tokenizer_path,
+                compile_model=not args.no_compile,
+                quantize=args.quantize,
+                kv_cache_dtype=args.kv_cache_dtype,
+                prefix_cache=args.prefix_cache,
+                draft_model_path=args.draft_model_path,
+                response_cache_size=args.response_cache_size,
+                # The API scheduler mostly runs single requests or full batches
+                warmup_batch_sizes=(1, args.max_batch_size) if args.mode == "api" else (1,),
+                warmup_max_new_tokens=args.max_new_tokens
+            )
     except Exception as e:
         print(f"❌ Error loading model: {e}")
         sys.exit(1)
@@ -423,13 +1330,19 @@ def main():
     
     elif args.mode == "api":
         print(f"🚀 Starting API server on {args.host}:{args.port}")
-        app = create_app(model_server)
+        app = create_app(model_server, args.max_batch_size, args.max_wait_ms)
         
+        # One process owns one ModelServer: for several GPUs, start one server per
+        # GPU (CUDA_VISIBLE_DEVICES + --port) behind a load balancer
         uvicorn.run(
             app,
             host=args.host,
             port=args.port,
-            log_level="info"
+            # uvloop/httptools when installed (uvicorn[standard]), asyncio/h11 otherwise
+            loop="auto",
+            http="auto",
+            workers=1,
+            log_level=args.log_level
         )
 
 
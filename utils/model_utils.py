@@ -13,6 +13,7 @@ from typing import Dict, Optional, Union
 from transformers import (
     AutoConfig,
     AutoModelForCausalLM,
+    BitsAndBytesConfig,
     LlamaConfig,
     LlamaForCausalLM,
     GPT2Config,
@@ -104,6 +105,13 @@ def detect_flash_attention() -> tuple[bool, str]:
         return False, "FlashAttention-2 not available (see installation)"
 
 
+def _select_attn_implementation(device: str) -> str:
+    """FlashAttention-2 on CUDA when installed, PyTorch SDPA fused kernels otherwise."""
+    if device == "cuda" and detect_flash_attention()[0]:
+        return "flash_attention_2"
+    return "sdpa"
+
+
 def _get_config_value(config, key, default=None):
     """Helper function to get configuration values from either dict or object."""
     if hasattr(config, key):
@@ -490,7 +498,9 @@ def load_checkpoint(model: PreTrainedModel, optimizer: torch.optim.Optimizer,
         )
 
 
-def load_pretrained_model(model_path: str, device: str = "auto") -> PreTrainedModel:
+def load_pretrained_model(model_path: str, device: str = "auto",
+                          torch_dtype: Optional[torch.dtype] = None,
+                          attn_implementation: Optional[str] = None) -> PreTrainedModel:
     """Load a pre-trained model."""
     
     model_path = Path(model_path)
@@ -499,16 +509,26 @@ def load_pretrained_model(model_path: str, device: str = "auto") -> PreTrainedMo
     if device == "auto":
         device = "cuda" if torch.cuda.is_available() else "cpu"
     
+    if attn_implementation is None:
+        attn_implementation = _select_attn_implementation(device)
+    
+    # Only an explicitly requested dtype applies to the manual fallback below
+    requested_dtype = torch_dtype
+    if torch_dtype is None:
+        torch_dtype = torch.float16 if device == "cuda" else torch.float32
+    
     print(f"Loading model from {model_path} on {device}...")
     
     try:
-        # Attempt loading with AutoModel
+        # Attempt loading with AutoModel: safetensors weights are memory-mapped
+        # and streamed to the target device in the target dtype
         model = AutoModelForCausalLM.from_pretrained(
             str(model_path),
-            torch_dtype=torch.float16 if device == "cuda" else torch.float32,
+            torch_dtype=torch_dtype,
             device_map="auto" if device == "cuda" else None,
+            low_cpu_mem_usage=True,
             trust_remote_code=True,
-            use_flash_attention_2=True
+            attn_implementation=attn_implementation
         )
         
         if device != "cuda":
@@ -523,11 +543,22 @@ def load_pretrained_model(model_path: str, device: str = "auto") -> PreTrainedMo
             with open(config_path, 'r') as f:
                 config_dict = json.load(f)
             
-            model = create_model(config_dict)
+            # Create parameters directly in the requested dtype (no FP32 copy in host RAM)
+            default_dtype = torch.get_default_dtype()
+            if requested_dtype is not None:
+                torch.set_default_dtype(requested_dtype)
+            try:
+                model = create_model(config_dict, use_flash_attention=attn_implementation == "flash_attention_2")
+            finally:
+                torch.set_default_dtype(default_dtype)
             
-            # Loading weights if available
+            # Loading weights if available (safetensors first: memory-mapped, no pickle)
+            safetensors_path = model_path / "model.safetensors"
             weights_path = model_path / "pytorch_model.bin"
-            if weights_path.exists():
+            if safetensors_path.exists():
+                from safetensors.torch import load_file
+                model.load_state_dict(load_file(safetensors_path, device=device))
+            elif weights_path.exists():
                 state_dict = torch.load(weights_path, map_location=device)
                 model.load_state_dict(state_dict)
             
@@ -543,6 +574,50 @@ def load_pretrained_model(model_path: str, device: str = "auto") -> PreTrainedMo
     return model
 
 
+def load_quantized_model(model_path: str, quantize: str = "int8",
+                         attn_implementation: Optional[str] = None) -> PreTrainedModel:
+    """
+    Load a pre-trained model with bitsandbytes weight quantization.
+    
+    Args:
+        model_path: Path to the model directory
+        quantize: Quantization scheme ("int8" for LLM.int8(), "nf4" for 4-bit NormalFloat)
+        attn_implementation: Attention implementation (default: FlashAttention-2 if installed, else SDPA)
+        
+    Returns:
+        PreTrainedModel: Quantized model in evaluation mode
+    """
+    if not torch.cuda.is_available():
+        raise ValueError("bitsandbytes quantization requires a CUDA device")
+    
+    if quantize == "int8":
+        quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+    elif quantize == "nf4":
+        quantization_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=torch.float16,
+            bnb_4bit_quant_type="nf4"
+        )
+    else:
+        raise ValueError(f"Unknown quantization scheme: {quantize}")
+    
+    print(f"Loading model from {model_path} with {quantize} quantization...")
+    
+    model = AutoModelForCausalLM.from_pretrained(
+        str(model_path),
+        quantization_config=quantization_config,
+        torch_dtype=torch.float16,
+        device_map="auto",
+        trust_remote_code=True,
+        attn_implementation=attn_implementation or _select_attn_implementation("cuda")
+    )
+    model.eval()
+    
+    print(f"Model loaded: {sum(p.numel() for p in model.parameters()):,} parameters ({quantize})")
+    
+    return model
+
+
 def estimate_parameters(config_dict) -> int:
     """
     Estimate the number of parameters based on configuration.